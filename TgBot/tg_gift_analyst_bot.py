@@ -20,73 +20,124 @@ Telegram Gift Analyst Bot — минимальный работающий про
   python tg_gift_analyst_bot.py
 
 Зависимости:
-  pip install "python-telegram-bot>=22.1,<23" pydantic
+  pip install "python-telegram-bot[http2,job-queue,rate-limiter]>=22.1,<23" pydantic msgspec
 
 Автор: вы + ChatGPT. Лицензия: MIT.
 """
 from __future__ import annotations
 
 import asyncio
-import json
+import contextlib
 import os
 import time
+from collections import Counter
 from dataclasses import dataclass
 from datetime import datetime, timezone
+from html import escape
 from typing import Any, Dict, List, Optional, Tuple
 
-from pydantic import BaseModel
-from telegram import (
-    Update,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    Message,
-)
+import msgspec
+from pydantic import BaseModel, Field
+from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
-    CallbackQueryHandler,
-    MessageHandler,
-    filters,
     BusinessConnectionHandler,
 )
+from telegram.request import HTTPXRequest
 
 STATE_PATH = os.environ.get("STATE_PATH", "./state.json")
 DEFAULT_POLL_INTERVAL_SEC = int(os.environ.get("POLL_INTERVAL_SEC", "1800"))  # 30 мин
+CATALOG_TTL_SEC = int(os.environ.get("CATALOG_TTL_SEC", "300"))  # 5 мин
+PORTFOLIO_TTL_SEC = int(os.environ.get("PORTFOLIO_TTL_SEC", "60"))  # 1 мин
+STATE_FLUSH_INTERVAL_SEC = float(os.environ.get("STATE_FLUSH_INTERVAL_SEC", "5"))
+LONG_POLL_TIMEOUT_SEC = int(os.environ.get("LONG_POLL_TIMEOUT_SEC", "25"))
+WATCH_CONCURRENCY = int(os.environ.get("WATCH_CONCURRENCY", "8"))  # одновременных анализов в watch_tick_all
 
 # --------------------------
 # Простая файловая «база данных»
 # --------------------------
-class State(BaseModel):
+class State(msgspec.Struct, dict=True):
     # key: telegram user id (int)
     connections: Dict[str, str] = {}  # user_id -> business_connection_id
     chats: Dict[str, int] = {}        # user_id -> last chat_id для личных сообщений
     settings: Dict[str, Dict[str, Any]] = {}  # user_id -> {"min_profit_stars": int, "min_profit_pct": float}
-    last_catalog: Dict[str, Any] = {}         # кеш каталога gifts
-    last_portfolio: Dict[str, Any] = {}       # user_id -> snapshot
+    # Каталог и снимки портфелей не сохраняются: они живут в памяти (_catalog_cache, _portfolios)
+    # и перечитываются из Bot API по TTL. Старые ключи last_catalog/last_portfolio при загрузке игнорируются.
+
+    def __post_init__(self) -> None:
+        # Не поле структуры (в JSON не попадает): изменения помечаются флагом,
+        # а на диск их сбрасывает flush_state_loop()
+        self._dirty = False
 
     @classmethod
     def load(cls) -> "State":
         if os.path.exists(STATE_PATH):
-            with open(STATE_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            return cls(**data)
+            with open(STATE_PATH, "rb") as f:
+                return msgspec.json.decode(f.read(), type=cls)
         return cls()
 
-    def save(self) -> None:
+    def mark_dirty(self) -> None:
+        self._dirty = True
+
+    async def save(self) -> None:
+        # Кодируем в event loop (снимок без гонок с хендлерами), пишем файл в отдельном потоке
+        self._dirty = False
+        payload = msgspec.json.encode(self)
+        write = asyncio.ensure_future(asyncio.to_thread(self._write_atomic, payload))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # Поток не отменить: дождёмся записи, чтобы следующий save() не гонялся с ним за .tmp
+            await write
+            raise
+        except Exception:
+            self._dirty = True  # повторим при следующем сбросе
+            raise
+
+    @staticmethod
+    def _write_atomic(payload: bytes) -> None:
         tmp = STATE_PATH + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            f.write(self.model_dump_json(indent=2))
+        with open(tmp, "wb") as f:
+            f.write(payload)
         os.replace(tmp, STATE_PATH)
 
+
+async def flush_state() -> None:
+    """Записать STATE на диск, если были изменения."""
+    if STATE._dirty:
+        await STATE.save()
+
+
+async def flush_state_loop() -> None:
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL_SEC)
+        try:
+            await flush_state()
+        except Exception as e:
+            print("[flush_state] error:", e)
+
 STATE = State.load()
 
 # --------------------------
 # Утилиты форматирования
 # --------------------------
 
+def _emoji(obj: Any, default: str) -> str:
+    """Эмодзи стикера подарка или default (у UniqueGift стикера нет)."""
+    s = getattr(obj, "sticker", None)
+    return (s.emoji if s is not None else None) or default
+
+
+def _content_digest(items: List[Dict[str, Any]]) -> int:
+    """Хеш содержимого списка плоских dict (значения — скаляры), независимый от времени загрузки."""
+    return hash(tuple(tuple(d.items()) for d in items))
+
+
 def fmt_stars(val: Optional[int]) -> str:
     return f"{val} ⭐" if isinstance(val, int) else "—"
 
@@ -97,6 +148,19 @@ def human_dt(dt: Optional[datetime]) -> str:
     return dt.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%MZ")
 
 
+def format_suggestions(suggestions: List[Suggestion]) -> str:
+    """HTML-текст для списка рекомендаций (title/details экранируются)."""
+    parts: List[str] = []
+    append = parts.append
+    for s in suggestions:
+        append("• <b>")
+        append(escape(s.title))
+        append("</b>\n")
+        append(escape(s.details))
+        append("\n\n")
+    return "".join(parts)[:-2]
+
+
 # --------------------------
 # Плагины/заглушки цен с маркетплейса (для будущего)
 # --------------------------
@@ -104,7 +168,7 @@ class MarketQuote(BaseModel):
     gift_id: str
     floor_stars: Optional[int] = None
     last_trade_stars: Optional[int] = None
-    ts: float = time.time()
+    ts: float = Field(default_factory=time.time)
 
 
 async def fetch_market_quotes_example(gift_ids: List[str]) -> Dict[str, MarketQuote]:
@@ -115,133 +179,207 @@ async def fetch_market_quotes_example(gift_ids: List[str]) -> Dict[str, MarketQu
 # --------------------------
 # Бизнес‑логика анализа портфеля
 # --------------------------
-@dataclass
+@dataclass(frozen=True)
 class Suggestion:
     title: str
     details: str
 
 
+# In-memory кеш каталога: повторные /catalog и /analyze в пределах TTL не ходят в Telegram
+# digest — хеш содержимого: меняется, только если каталог действительно изменился
+_catalog_cache: Dict[str, Any] = {"ts": 0.0, "data": None, "digest": None}
+# user_id -> последний снимок портфеля (только в памяти)
+_portfolios: Dict[str, Dict[str, Any]] = {}
+# Одновременные запросы каталога (например, из watch_tick_all) ждут один общий запрос
+_catalog_refresh_lock = asyncio.Lock()
+
+
+async def get_catalog(context: ContextTypes.DEFAULT_TYPE) -> List[Dict[str, Any]]:
+    """Каталог из кеша, если он моложе CATALOG_TTL_SEC, иначе — одно обновление на всех ожидающих."""
+    async with _catalog_refresh_lock:
+        if _catalog_cache["data"] is not None and time.time() - _catalog_cache["ts"] < CATALOG_TTL_SEC:
+            return _catalog_cache["data"]
+        return await build_catalog(context)
+
+
 async def build_catalog(context: ContextTypes.DEFAULT_TYPE) -> List[Dict[str, Any]]:
-    """Получить доступные подарки (getAvailableGifts)."""
+    """Получить доступные подарки (getAvailableGifts) и обновить кеш. Обычно вызывается через get_catalog()."""
     bot = context.bot
     gifts_obj = await bot.get_available_gifts()
     catalog: List[Dict[str, Any]] = []
+    append = catalog.append
     for g in gifts_obj.gifts:
         # Gift: id, sticker, star_count, total_count?, remaining_count?, upgrade_star_count?
-        catalog.append(
+        append(
             {
                 "id": g.id,
-                "title": getattr(getattr(g, "sticker", None), "emoji", None) or "Gift",
-                "star_count": getattr(g, "star_count", None),
-                "total_count": getattr(g, "total_count", None),
-                "remaining_count": getattr(g, "remaining_count", None),
-                "upgrade_star_count": getattr(g, "upgrade_star_count", None),
+                "title": _emoji(g, "Gift"),
+                "star_count": g.star_count,
+                "total_count": g.total_count,
+                "remaining_count": g.remaining_count,
+                "upgrade_star_count": g.upgrade_star_count,
             }
         )
-    STATE.last_catalog = {g["id"]: g for g in catalog}
-    STATE.save()
+    _catalog_cache["ts"] = time.time()
+    _catalog_cache["data"] = catalog
+    _catalog_cache["digest"] = _content_digest(catalog)
     return catalog
 
 
 async def fetch_portfolio(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> Dict[str, Any]:
-    """Загрузить все подарки бизнес‑аккаунта пользователя (getBusinessAccountGifts + пагинация)."""
+    """Загрузить все подарки бизнес‑аккаунта пользователя (getBusinessAccountGifts + пагинация).
+
+    Снимок моложе PORTFOLIO_TTL_SEC берётся из _portfolios без запроса к API.
+    """
     bot = context.bot
     bc = STATE.connections.get(str(user_id))
     if not bc:
         return {"gifts": [], "total_count": 0}
 
-    all_gifts = []
-    offset = None
+    cached = _portfolios.get(str(user_id))
+    if cached and time.time() - cached.get("ts", 0.0) < PORTFOLIO_TTL_SEC:
+        return cached
+
+    all_gifts: List[Dict[str, Any]] = []
+    append = all_gifts.append
     total = 0
-    while True:
-        resp = await bot.get_business_account_gifts(business_connection_id=bc, offset=offset, limit=50)
-        total = resp.total_count
-        for og in resp.gifts:
-            item: Dict[str, Any] = {"type": og.type}
-            # REGULAR
-            if og.type == "regular":
-                item.update(
-                    {
-                        "class": "regular",
-                        "gift_id": getattr(og.gift, "id", None),
-                        "gift_title": getattr(getattr(og.gift, "sticker", None), "emoji", None) or "Gift",
-                        "convert_star_count": getattr(og, "convert_star_count", None),
-                        "can_be_upgraded": getattr(og, "can_be_upgraded", None),
-                        "prepaid_upgrade_star_count": getattr(og, "prepaid_upgrade_star_count", None),
-                        "text": getattr(og, "text", None),
-                    }
-                )
-            else:  # UNIQUE
-                ug = og.gift  # UniqueGift
-                item.update(
-                    {
-                        "class": "unique",
-                        "gift_id": getattr(ug, "id", None),
-                        "gift_title": getattr(getattr(ug, "sticker", None), "emoji", None) or "Unique",
-                        "rank": getattr(ug, "rank", None),
-                        "is_sticker": True,
-                        "can_be_transferred": getattr(og, "can_be_transferred", None),
-                        "transfer_star_count": getattr(og, "transfer_star_count", None),
-                        "next_transfer_date": getattr(og, "next_transfer_date", None).isoformat() if getattr(og, "next_transfer_date", None) else None,
-                    }
+    # next_offset — непрозрачный курсор, параллельно страницы не запросить.
+    # Поэтому следующую страницу запрашиваем сразу, пока разбираем текущую.
+    pending: Optional[asyncio.Task] = asyncio.create_task(
+        bot.get_business_account_gifts(business_connection_id=bc, offset=None, limit=50)
+    )
+    try:
+        while pending is not None:
+            resp = await pending
+            pending = None
+            if resp.next_offset:
+                pending = asyncio.create_task(
+                    bot.get_business_account_gifts(business_connection_id=bc, offset=resp.next_offset, limit=50)
                 )
-            all_gifts.append(item)
-        if not resp.next_offset:
-            break
-        offset = resp.next_offset
-
-    portfolio = {"total_count": total, "gifts": all_gifts, "ts": time.time()}
-    STATE.last_portfolio[str(user_id)] = portfolio
-    STATE.save()
+            total = resp.total_count
+            for og in resp.gifts:
+                item: Dict[str, Any] = {"type": og.type}
+                # REGULAR
+                if og.type == "regular":
+                    item.update(
+                        {
+                            "class": "regular",
+                            "gift_id": og.gift.id,
+                            "gift_title": _emoji(og.gift, "Gift"),
+                            "convert_star_count": og.convert_star_count,
+                            "can_be_upgraded": og.can_be_upgraded,
+                            "prepaid_upgrade_star_count": og.prepaid_upgrade_star_count,
+                            "text": og.text,
+                        }
+                    )
+                else:  # UNIQUE
+                    ug = og.gift  # UniqueGift: id/rank есть не во всех версиях Bot API
+                    next_transfer = og.next_transfer_date
+                    item.update(
+                        {
+                            "class": "unique",
+                            "gift_id": getattr(ug, "id", None),
+                            "gift_title": _emoji(ug, "Unique"),
+                            "rank": getattr(ug, "rank", None),
+                            "is_sticker": True,
+                            "can_be_transferred": og.can_be_transferred,
+                            "transfer_star_count": og.transfer_star_count,
+                            "next_transfer_ts": next_transfer.timestamp() if next_transfer else None,
+                        }
+                    )
+                append(item)
+    finally:
+        if pending is not None:
+            # Задача могла уже завершиться с ошибкой — забрать её исключение, а не просто отменить
+            pending.cancel()
+            with contextlib.suppress(Exception, asyncio.CancelledError):
+                await pending
+
+    portfolio = {"total_count": total, "gifts": all_gifts, "ts": time.time(), "digest": _content_digest(all_gifts)}
+    _portfolios[str(user_id)] = portfolio
     return portfolio
 
 
+def _suggestion_for_regular(
+    gift_title: str, conv: Optional[int], can_up: Optional[bool], up: Optional[int], min_profit_stars: int
+) -> Optional[Suggestion]:
+    if isinstance(conv, int) and conv >= min_profit_stars:
+        return Suggestion(
+            title=f"Конвертировать в Stars: {gift_title}",
+            details=f"Можно получить {fmt_stars(conv)} за обычный подарок."
+        )
+    # Оценка апгрейда: если у соответствующего Gift есть upgrade_star_count
+    if can_up and isinstance(up, int):
+        return Suggestion(
+            title=f"Подумать об апгрейде: {gift_title}",
+            details=f"Апгрейд до уникального стоит {fmt_stars(up)}. Оцените рынок перед апгрейдом."
+        )
+    return None
+
+
+# user_id -> (ключ входных данных, рекомендации по обычным подаркам)
+_analysis_cache: Dict[str, Tuple[Tuple[Any, ...], List[Suggestion]]] = {}
+
+
 async def analyze_portfolio(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> Tuple[List[Suggestion], Dict[str, Any]]:
-    """Сформировать список рекомендаций на основе каталога/портфеля/котировок."""
-    catalog = STATE.last_catalog or {c["id"]: c for c in await build_catalog(context)}
-    portfolio = STATE.last_portfolio.get(str(user_id)) or await fetch_portfolio(context, user_id)
+    """Сформировать список рекомендаций на основе каталога/портфеля/котировок.
+
+    Рекомендации по обычным подаркам кешируются, пока не изменились содержимое портфеля, каталога
+    и порог пользователя. Уникальные пересчитываются всегда: они зависят от времени и котировок.
+    """
+    catalog_list = await get_catalog(context)
+    # Digest читаем сразу, до следующего await: пока грузится портфель, каталог может обновиться
+    catalog_digest = _catalog_cache["digest"]
+    catalog = {c["id"]: c for c in catalog_list}
+    portfolio = await fetch_portfolio(context, user_id)
+
+    uid = str(user_id)
+    settings = STATE.settings.get(uid, {"min_profit_stars": 0, "min_profit_pct": 0.0})
+    min_profit_stars = int(settings.get("min_profit_stars", 0))
+
+    # Один проход по портфелю: разбить на обычные и уникальные
+    regulars: List[Dict[str, Any]] = []
+    uniques: List[Dict[str, Any]] = []
+    unique_ids: List[str] = []
+    for g in portfolio["gifts"]:
+        cls = g.get("class")
+        if cls == "regular":
+            regulars.append(g)
+        elif cls == "unique":
+            uniques.append(g)
+            if g.get("gift_id"):
+                unique_ids.append(g["gift_id"])
 
     # Подтянуть котировки (заглушка)
-    unique_ids = [g["gift_id"] for g in portfolio["gifts"] if g.get("class") == "unique" and g.get("gift_id")]
     quotes = await fetch_market_quotes_example(unique_ids)
 
-    suggestions: List[Suggestion] = []
-
     # 1) REGULAR: конвертировать в Stars, если доступно и > минимального порога
-    settings = STATE.settings.get(str(user_id), {"min_profit_stars": 0, "min_profit_pct": 0.0})
-    min_profit_stars = int(settings.get("min_profit_stars", 0))
-
-    regulars = [g for g in portfolio["gifts"] if g.get("class") == "regular"]
-    for r in regulars:
-        conv = r.get("convert_star_count")
-        if isinstance(conv, int) and conv >= min_profit_stars:
-            suggestions.append(
-                Suggestion(
-                    title=f"Конвертировать в Stars: {r['gift_title']}",
-                    details=f"Можно получить {fmt_stars(conv)} за обычный подарок."
-                )
-            )
-        elif r.get("can_be_upgraded"):
-            # Оценка апгрейда: если у соответствующего Gift есть upgrade_star_count
+    key = (portfolio.get("digest"), catalog_digest, min_profit_stars)
+    cached = _analysis_cache.get(uid)
+    if cached and cached[0] == key:
+        regular_suggestions = cached[1]
+    else:
+        regular_suggestions = []
+        for r in regulars:
             g = catalog.get(r.get("gift_id"))
-            up = g.get("upgrade_star_count") if g else None
-            if isinstance(up, int):
-                suggestions.append(
-                    Suggestion(
-                        title=f"Подумать об апгрейде: {r['gift_title']}",
-                        details=f"Апгрейд до уникального стоит {fmt_stars(up)}. Оцените рынок перед апгрейдом."
-                    )
-                )
+            s = _suggestion_for_regular(
+                r["gift_title"],
+                r.get("convert_star_count"),
+                r.get("can_be_upgraded"),
+                g.get("upgrade_star_count") if g else None,
+                min_profit_stars,
+            )
+            if s is not None:
+                regular_suggestions.append(s)
+        _analysis_cache[uid] = (key, regular_suggestions)
+
+    suggestions: List[Suggestion] = list(regular_suggestions)
 
     # 2) UNIQUE: можно ли уже перевести (продать/подарить)
-    for u in [g for g in portfolio["gifts"] if g.get("class") == "unique"]:
-        next_transfer_iso = u.get("next_transfer_date")
-        can_transfer = True
-        if next_transfer_iso:
-            try:
-                can_transfer = datetime.fromisoformat(next_transfer_iso).timestamp() <= time.time()
-            except Exception:
-                can_transfer = True
+    now = time.time()
+    for u in uniques:
+        ts = u.get("next_transfer_ts")
+        can_transfer = ts is None or ts <= now
         if can_transfer:
             q = quotes.get(u["gift_id"]) if u.get("gift_id") else None
             floor = q.floor_stars if q else None
@@ -268,7 +406,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if user:
         STATE.chats[str(user.id)] = update.effective_chat.id
-        STATE.save()
+        STATE.mark_dirty()
     text = (
         "Привет! Я бот‑аналитик подарков в Telegram.\n\n"
         "Что я умею:\n"
@@ -305,12 +443,12 @@ async def on_business_connection(update: Update, context: ContextTypes.DEFAULT_T
         return
     STATE.connections[str(user.id)] = bc.id
     STATE.chats[str(user.id)] = update.effective_chat.id if update.effective_chat else STATE.chats.get(str(user.id))
-    STATE.save()
+    STATE.mark_dirty()
     await context.bot.send_message(chat_id=STATE.chats[str(user.id)], text="Бизнес‑подключение сохранено ✅. Теперь доступна команда /portfolio.")
 
 
 async def catalog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    catalog = await build_catalog(context)
+    catalog = await get_catalog(context)
     # Отобразим первые 10 позиций
     head = "Каталог подарков (фрагмент):\n"
     lines = []
@@ -326,8 +464,8 @@ async def portfolio_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     pf = await fetch_portfolio(context, user.id)
     total = pf.get("total_count", 0)
-    regs = sum(1 for g in pf["gifts"] if g.get("class") == "regular")
-    unqs = sum(1 for g in pf["gifts"] if g.get("class") == "unique")
+    by_class = Counter(g.get("class") for g in pf["gifts"])
+    regs, unqs = by_class["regular"], by_class["unique"]
     await update.effective_message.reply_text(
         f"У вас {total} подарков: {regs} обычных и {unqs} уникальных.\n" "Используйте /analyze для рекомендаций."
     )
@@ -338,7 +476,7 @@ async def analyze_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if not user:
         return
     suggestions, _ = await analyze_portfolio(context, user.id)
-    txt = "\n\n".join([f"• <b>{s.title}</b>\n{s.details}" for s in suggestions])
+    txt = format_suggestions(suggestions)
     await update.effective_message.reply_text(txt, parse_mode=ParseMode.HTML)
 
 
@@ -351,34 +489,52 @@ async def watch_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     min_pct = float(args[1]) if len(args) >= 2 else 0.0
 
     STATE.settings[str(user.id)] = {"min_profit_stars": min_stars, "min_profit_pct": min_pct}
-    STATE.save()
-
-    # Запустим периодическую задачу
-    job_name = f"watch_{user.id}"
-    # Сначала отменим старую, если была
-    jobs = context.job_queue.get_jobs_by_name(job_name)
-    for j in jobs:
-        j.schedule_removal()
+    STATE.mark_dirty()
 
-    context.job_queue.run_repeating(callback=watch_tick, interval=DEFAULT_POLL_INTERVAL_SEC, name=job_name, data={"user_id": user.id})
+    # Отдельной задачи не нужно: watch_tick_all обходит всех пользователей из STATE.settings
 
     await update.effective_message.reply_text(
         f"Алерты включены: мин профит {min_stars}⭐, мин {min_pct}%. Буду проверять раз в {DEFAULT_POLL_INTERVAL_SEC//60} мин."
     )
 
 
-async def watch_tick(context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = context.job.data.get("user_id")
+async def watch_tick_all(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая проверка всех, кто включил /watch: один каталог на всех, анализ и рассылка параллельно."""
+    user_ids = [int(uid) for uid in STATE.settings if STATE.chats.get(uid)]
+    if not user_ids:
+        return
     try:
-        suggestions, _ = await analyze_portfolio(context, user_id)
-        if suggestions:
-            chat_id = STATE.chats.get(str(user_id))
-            if chat_id:
-                txt = "\n\n".join([f"• <b>{s.title}</b>\n{s.details}" for s in suggestions])
-                await context.bot.send_message(chat_id=chat_id, text=f"Обновления по портфелю:\n\n{txt}", parse_mode=ParseMode.HTML)
+        await get_catalog(context)  # прогреть общий кеш каталога до параллельного анализа
     except Exception as e:
-        # Мягкое логирование в консоль
         print("[watch_tick] error:", e)
+        return
+
+    sem = asyncio.Semaphore(WATCH_CONCURRENCY)
+
+    async def analyze_limited(uid: int) -> Tuple[List[Suggestion], Dict[str, Any]]:
+        async with sem:
+            return await analyze_portfolio(context, uid)
+
+    results = await asyncio.gather(*(analyze_limited(uid) for uid in user_ids), return_exceptions=True)
+    msgs: List[Tuple[int, str]] = []
+    for uid, res in zip(user_ids, results):
+        if isinstance(res, BaseException):
+            # Мягкое логирование в консоль
+            print(f"[watch_tick] error for {uid}:", res)
+            continue
+        suggestions, _ = res
+        if suggestions:
+            txt = format_suggestions(suggestions)
+            msgs.append((STATE.chats[str(uid)], f"Обновления по портфелю:\n\n{txt}"))
+
+    # Темп отправки и повторы после 429 (RetryAfter) обеспечивает AIORateLimiter, см. main()
+    sent = await asyncio.gather(
+        *(context.bot.send_message(chat_id=cid, text=t, parse_mode=ParseMode.HTML) for cid, t in msgs),
+        return_exceptions=True,
+    )
+    for (cid, _), res in zip(msgs, sent):
+        if isinstance(res, BaseException):
+            print(f"[watch_tick] send error for chat {cid}:", res)
 
 
 def require_token() -> str:
@@ -389,8 +545,18 @@ def require_token() -> str:
 
 
 async def main() -> None:
+    # HTTP/2: параллельные запросы к Bot API мультиплексируются в одном соединении
+    request = HTTPXRequest(http_version="2", connection_pool_size=64, read_timeout=25, connect_timeout=10)
+    # getUpdates сам добавляет timeout long polling к read_timeout
+    get_updates_request = HTTPXRequest(http_version="2", connection_pool_size=1, connect_timeout=10)
     app: Application = (
-        ApplicationBuilder().token(require_token()).build()
+        ApplicationBuilder()
+        .token(require_token())
+        .request(request)
+        .get_updates_request(get_updates_request)
+        # Лимиты Bot API (~30 сообщений/с) и повтор запросов после RetryAfter вместо потери алертов
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .build()
     )
 
     app.add_handler(CommandHandler("start", start))
@@ -402,18 +568,33 @@ async def main() -> None:
     app.add_handler(CommandHandler("analyze", analyze_cmd))
     app.add_handler(CommandHandler("watch", watch_cmd))
 
+    app.job_queue.run_repeating(
+        callback=watch_tick_all, interval=DEFAULT_POLL_INTERVAL_SEC, first=DEFAULT_POLL_INTERVAL_SEC, name="watch"
+    )
+
     # Пуллинг
     print("Gift Analyst Bot запущен. Нажмите Ctrl+C для остановки.")
     await app.initialize()
     await app.start()
+    flusher = asyncio.create_task(flush_state_loop())
     try:
-        await app.updater.start_polling(allowed_updates=["message", "business_connection"])  # type: ignore[attr-defined]
+        await app.updater.start_polling(  # type: ignore[attr-defined]
+            # Только типы, которые обрабатывают наши хендлеры: команды и business_connection
+            timeout=LONG_POLL_TIMEOUT_SEC, allowed_updates=[Update.MESSAGE, Update.BUSINESS_CONNECTION]
+        )
         while True:
             await asyncio.sleep(3600)
     finally:
-        await app.updater.stop()  # type: ignore[attr-defined]
-        await app.stop()
-        await app.shutdown()
+        try:
+            await app.updater.stop()  # type: ignore[attr-defined]
+            await app.stop()
+            await app.shutdown()
+        finally:
+            # Последние изменения (до STATE_FLUSH_INTERVAL_SEC) сохраняем, даже если остановка PTB упала
+            flusher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await flusher
+            await flush_state()
 
 
 if __name__ == "__main__":